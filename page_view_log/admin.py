@@ -1,8 +1,12 @@
 from __future__ import unicode_literals
 from django.contrib import admin
 from django.contrib.auth import get_user_model
+from django.core.exceptions import PermissionDenied
+from django.template.response import TemplateResponse
+from django.urls import path
 
 from page_view_log.models import UserAgent, Url, ViewName, PageViewLog
+from page_view_log.utils import HeavyHitterTracker, PAGE_VIEW_LOG_HEAVY_HITTERS_WINDOW
 
 class UserAgentAdmin(admin.ModelAdmin):
     search_fields = ('user_agent_hash','user_agent_string')
@@ -113,6 +117,42 @@ class PageViewLogAdmin(admin.ModelAdmin):
             queryset = queryset.filter(id__in=ids)
         return queryset, False
 
+    def get_urls(self):
+        urls = [
+            path('heavy_hitters/', self.admin_site.admin_view(self.heavy_hitters_view), name='page_view_log_heavy_hitters'),
+        ]
+        return urls + super(PageViewLogAdmin, self).get_urls()
+
+    def heavy_hitters_view(self, request):
+        """ Lists the top ips / users / urls in the last N minutes.
+            These come from the streaming counts kept by the middleware (see: PAGE_VIEW_LOG_TRACK_HEAVY_HITTERS); we never query the PageViewLog table here.
+        """
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+
+        try:
+            minutes = int(request.GET.get('minutes') or 15)
+        except ValueError:
+            minutes = 15
+        minutes = max(1, min(minutes, PAGE_VIEW_LOG_HEAVY_HITTERS_WINDOW))
+
+        top_users = HeavyHitterTracker.top('user_id', minutes)
+        users = get_user_model().objects.in_bulk([user_id for user_id, count, error in top_users])
+
+        context = dict(
+            self.admin_site.each_context(request),
+            opts = self.model._meta,
+            title = 'Top IPs, users and URLs in the last %s minutes' % minutes,
+            minutes = minutes,
+            window = PAGE_VIEW_LOG_HEAVY_HITTERS_WINDOW,
+            tables = [
+                ('IP address', HeavyHitterTracker.top('ip_address', minutes)),
+                ('User', [(users.get(user_id, user_id), count, error) for user_id, count, error in top_users]),
+                ('URL', HeavyHitterTracker.top('url', minutes)),
+            ],
+        )
+        return TemplateResponse(request, 'admin/page_view_log/heavy_hitters.html', context)
+
 admin.site.register(UserAgent, UserAgentAdmin)
 admin.site.register(Url, UrlAdmin)
 admin.site.register(ViewName, ViewNameAdmin)
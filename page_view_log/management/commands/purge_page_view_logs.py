@@ -0,0 +1,24 @@
+from __future__ import unicode_literals
+from django.core.management.base import BaseCommand
+
+from page_view_log.models import cleanup_old_logs, PAGE_VIEW_LOG_RETENTION_DAYS
+
+
+class Command(BaseCommand):
+    help = "Deletes PageViewLogs older than PAGE_VIEW_LOG_RETENTION_DAYS, within a bounded amount of time. Run it regularly (ex: hourly) to keep up."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-seconds', type=float, default=None, help="Stop after this many seconds. Defaults to PAGE_VIEW_LOG_CLEANUP_MAX_SECONDS.")
+        parser.add_argument('--chunk-size', type=int, default=None, help="Number of records to delete at a time. Defaults to PAGE_VIEW_LOG_CLEANUP_CHUNK_SIZE.")
+        parser.add_argument('--sleep', type=float, default=None, help="Seconds to pause between chunks. Defaults to PAGE_VIEW_LOG_CLEANUP_SLEEP.")
+
+    def handle(self, *args, **options):
+        finished = cleanup_old_logs(
+            max_seconds = options['max_seconds'],
+            chunk_size = options['chunk_size'],
+            sleep = options['sleep'],
+            )
+        if finished:
+            self.stdout.write("Removed logs older than %s days." % PAGE_VIEW_LOG_RETENTION_DAYS)
+        else:
+            self.stdout.write("Ran out of time. The next run will continue where this one left off.")
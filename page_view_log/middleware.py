@@ -15,7 +15,7 @@ except ImportError:
         pass
 
 from page_view_log.models import UserAgent, Url, ViewName, PageViewLog, PAGE_VIEW_LOG_INCLUDES_ANONYMOUS
-from page_view_log.utils import page_view_log_queue, my_lru_cache
+from page_view_log.utils import page_view_log_queue, my_lru_cache, heavy_hitters, PAGE_VIEW_LOG_TRACK_HEAVY_HITTERS
 
 PAGE_VIEW_LOG_NO_DIBS_PATHS = getattr(settings, 'PAGE_VIEW_LOG_NO_DIBS_PATHS', None) or []
 PAGE_VIEW_LOG_FLUSH_IN_BATCHES = bool(getattr(settings, 'PAGE_VIEW_LOG_FLUSH_IN_BATCHES', None))
@@ -84,14 +84,23 @@ class PageViewLogMiddleware(MiddlewareMixin, object):
         except:
             user_id = None
 
-        if user_id or PAGE_VIEW_LOG_INCLUDES_ANONYMOUS:
+        if PAGE_VIEW_LOG_TRACK_HEAVY_HITTERS or user_id or PAGE_VIEW_LOG_INCLUDES_ANONYMOUS:
             # ip_address
-            ip_address = request.META['REMOTE_ADDR']
+            # Note: REMOTE_ADDR may be missing (ex: an ASGI request without a client).
+            ip_address = request.META.get('REMOTE_ADDR') or ''
             if request.META.get('HTTP_CF_CONNECTING_IP'):
                 ip_address = request.META['HTTP_CF_CONNECTING_IP']
             if request.META.get('HTTP_X_FORWARDED_FOR'):
                 ip_address = request.META['HTTP_X_FORWARDED_FOR'].split(',')[0]
 
+        url_string = request.META.get('PATH_INFO') or ''
+
+        if PAGE_VIEW_LOG_TRACK_HEAVY_HITTERS:
+            # count this request towards the 'top ips/users/urls' (in memory; flushed to the cache periodically)
+            # We count anonymous requests too, even if we don't log them; they're often the ones we're looking for.
+            heavy_hitters.record(ip_address, user_id, url_string)
+
+        if user_id or PAGE_VIEW_LOG_INCLUDES_ANONYMOUS:
             # user_agent
             user_agent_string = request.META.get('HTTP_USER_AGENT') or ''
             user_agent_hash = hashlib.md5(user_agent_string.encode('utf-8')).hexdigest()
@@ -112,7 +121,6 @@ class PageViewLogMiddleware(MiddlewareMixin, object):
                 my_lru_cache.set(cache_key, user_agent_id)
 
             # url
-            url_string = request.META.get('PATH_INFO') or ''
             url_hash = hashlib.md5(url_string.encode('utf-8')).hexdigest()
             cache_key = "pvl_%s" % url_hash
             url_id = my_lru_cache.get(cache_key)
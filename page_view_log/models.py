@@ -1,16 +1,26 @@
 from __future__ import unicode_literals
 from datetime import timedelta
+import time
 
 from django.db import models
+from django.db.models import Exists, OuterRef
 from django.db.utils import IntegrityError
 from django.conf import settings
-from django.core.cache import cache
 from django.utils import timezone
 
-from cron.signals import cron_daily
+try:
+    from cron.signals import cron_daily
+except ImportError:
+    # django-cron isn't installed. Use the `purge_page_view_logs` management command instead.
+    cron_daily = None
 
 
 PAGE_VIEW_LOG_INCLUDES_ANONYMOUS = getattr(settings, 'PAGE_VIEW_LOG_INCLUDES_ANONYMOUS', False)
+PAGE_VIEW_LOG_RETENTION_DAYS = getattr(settings, 'PAGE_VIEW_LOG_RETENTION_DAYS', 90)
+PAGE_VIEW_LOG_CLEANUP_MAX_SECONDS = getattr(settings, 'PAGE_VIEW_LOG_CLEANUP_MAX_SECONDS', 300)   # How long a single cleanup run may take.
+PAGE_VIEW_LOG_CLEANUP_CHUNK_SIZE = getattr(settings, 'PAGE_VIEW_LOG_CLEANUP_CHUNK_SIZE', 1000)   # Number of records to delete at a time.
+PAGE_VIEW_LOG_CLEANUP_SLEEP = getattr(settings, 'PAGE_VIEW_LOG_CLEANUP_SLEEP', 0.1)             # Seconds to pause between chunks, to leave room for other writes.
+PAGE_VIEW_LOG_CLEANUP_DAILY_MAX_SECONDS = getattr(settings, 'PAGE_VIEW_LOG_CLEANUP_DAILY_MAX_SECONDS', 4 * 60 * 60)   # How long the django-cron daily job may take.
 
 class UserAgent(models.Model):
     user_agent_hash = models.CharField(max_length=32, db_index=True)
@@ -64,88 +74,137 @@ class PageViewLog(models.Model):
     gen_time_in_seconds.admin_order_field = 'gen_time'
     gen_time_in_milliseconds.admin_order_field = 'gen_time'
 
-def cleanup_old_logs(**kwargs):
+class CleanupCheckpoint(models.Model):
+    """ Records how far a cleanup job has progressed. We keep this in the database (rather than the cache) so that it survives a cache flush. """
+    name = models.CharField(max_length=64, unique=True)
+    last_id = models.BigIntegerField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+    def __unicode__(self):
+        return self.__str__()
+
+def cleanup_old_logs(max_seconds=None, chunk_size=None, sleep=None):
+    """ Deletes PageViewLogs older than PAGE_VIEW_LOG_RETENTION_DAYS, followed by any orphaned UserAgents, Urls and ViewNames.
+        Work is done in chunks, pausing `sleep` seconds between each, and stops once `max_seconds` have passed. Progress is checkpointed, so the next run picks up where this one left off.
+        Returns True if we caught up, or False if we ran out of time.
+    """
+    if max_seconds is None:
+        max_seconds = PAGE_VIEW_LOG_CLEANUP_MAX_SECONDS
+    if chunk_size is None:
+        chunk_size = PAGE_VIEW_LOG_CLEANUP_CHUNK_SIZE
+    if sleep is None:
+        sleep = PAGE_VIEW_LOG_CLEANUP_SLEEP
+    deadline = time.time() + max_seconds
+
     # By default, django will need to load the results into memory in order to perform pre_delete and post_delete logic. We perform a 'raw' delete in order to expressly avoid this.
     # see: https://stackoverflow.com/a/36935536/341329
 
-    # Note: It's not efficient to query by timestamp directly, because it is not indexed.
-    cache_key = "page_view_log.models.cleanup_old_logs:last_id"
-    earliest_id = cache.get(cache_key)
-    if earliest_id is None:
-        # We try to avoid this query, because it may require a full table scan.
-        earliest_id = PageViewLog.objects.values_list('id', flat=True).earliest('id')
+    # Note: It's not efficient to query by timestamp directly, because it is not indexed. So we walk the table by id instead.
+    checkpoint, created = CleanupCheckpoint.objects.get_or_create(name='cleanup_old_logs')
 
-    cutoff = timezone.now() - timedelta(days=90)
-    for i in range(10**4):
-        # we delete them 1000 at a time, to avoid needing a big lock on this table.
-        qs = PageViewLog.objects.filter(id__lt=earliest_id + 1000).values_list('id', 'datetime')[:1000]
-        qs = list(qs)
+    cutoff = timezone.now() - timedelta(days=PAGE_VIEW_LOG_RETENTION_DAYS)
+    deleted_something = False
+    finished = True
+    while True:
+        qs = PageViewLog.objects.order_by('id')
+        if checkpoint.last_id is not None:
+            qs = qs.filter(id__gt=checkpoint.last_id)
+        qs = list(qs.values_list('id', 'datetime')[:chunk_size])
 
         if not qs:
-            # We got an empty list. That's unexpected.
-            # - It's possible that there are no PageViewLogs.
-            # - It's possible that our earliest_id is stale / off.
-            # Let's start over from scratch next time.
-            cache.delete(cache_key)
+            # There's nothing left to look at. That's ok!
             break
 
-        # narrow results to those that are stale.
+        # narrow results to those that are stale. We stop at the first 'current' record (even if there are stale ones after it), so that the checkpoint never moves past it.
         ids = []
         for pid, datetime in qs:
-            if datetime < cutoff:
-                ids.append(pid)
-
-        if not ids:
-            # We found records, but they're all still 'current'. That's ok!
-            break
+            if datetime >= cutoff:
+                break
+            ids.append(pid)
 
-        temp = PageViewLog.objects.filter(id__in=ids)
-        temp._raw_delete(temp.db)
+        if ids:
+            temp = PageViewLog.objects.filter(id__in=ids)
+            temp._raw_delete(temp.db)
+            deleted_something = True
 
-        # record our progress
-        earliest_id = max(ids)
-        cache.set(cache_key, earliest_id, None) # cache it forever
+            # record our progress
+            checkpoint.last_id = ids[-1]
+            checkpoint.save()
 
         if len(ids) < len(qs):
             # We found some records that are still 'current'. We're done for now.
             break
 
-    # remove orphan UserAgents
-    all_ids = UserAgent.objects.all().values_list('id', flat=True)
-    used_ids = PageViewLog.objects.values_list('user_agent_id', flat=True).distinct()
-    ids_to_delete = set(all_ids) - set(used_ids)
-    qs = UserAgent.objects.filter(id__in=ids_to_delete)
-    try:
-        qs._raw_delete(qs.db)
-    except IntegrityError:
-        pass
-
-    # remove orphan Urls
-    all_ids = Url.objects.all().values_list('id', flat=True)
-    used_ids = PageViewLog.objects.values_list('url_id', flat=True).distinct()
-    ids_to_delete = set(all_ids) - set(used_ids)
-    for i in range(10**4):
-        # There could be a lot of these!
-        # we delete them 1000 at a time, to avoid needing a big lock on this table.
-        selected_ids = list(ids_to_delete)[:1000]
-        if not selected_ids:
-            # we're all done.
+        if time.time() >= deadline:
+            finished = False
             break
-        qs = Url.objects.filter(id__in=selected_ids)
-        try:
-            qs._raw_delete(qs.db)
-        except IntegrityError:
-            pass
-        ids_to_delete -= set(selected_ids)
-
-    # remove orphan ViewNames
-    all_ids = ViewName.objects.all().values_list('id', flat=True)
-    used_ids = PageViewLog.objects.values_list('view_name_id', flat=True).distinct()
-    ids_to_delete = set(all_ids) - set(used_ids)
-    qs = ViewName.objects.filter(id__in=ids_to_delete)
-    try:
-        qs._raw_delete(qs.db)
-    except IntegrityError:
-        pass
-
-cron_daily.connect(cleanup_old_logs, dispatch_uid="cleanup_old_logs")
+        # give other writers a turn at the table.
+        time.sleep(sleep)
+
+    if deleted_something:
+        # we may have left some UserAgents, Urls and ViewNames behind. Schedule a pass to look for them.
+        for model, field_name in ORPHAN_MODELS:
+            orphan_checkpoint, created = CleanupCheckpoint.objects.get_or_create(name=orphan_checkpoint_name(model))
+            if orphan_checkpoint.last_id is None:
+                orphan_checkpoint.last_id = 0
+                orphan_checkpoint.save()
+
+    if not finished:
+        return False
+    return cleanup_orphans(deadline, chunk_size, sleep)
+
+ORPHAN_MODELS = [
+    (UserAgent, 'user_agent'),
+    (Url, 'url'),
+    (ViewName, 'view_name'),
+    ]
+
+def orphan_checkpoint_name(model):
+    return 'cleanup_orphans:%s' % model._meta.model_name
+
+def cleanup_orphans(deadline, chunk_size, sleep):
+    """ Removes UserAgents, Urls and ViewNames which are no longer referenced by any PageViewLog. Returns False if we ran out of time.
+        We walk each table by id, a chunk at a time, checking each chunk against PageViewLog's (indexed) foreign keys. That way we never need to scan the whole log table.
+        A pass only runs once some logs have been deleted (checkpoint.last_id is not None), and the checkpoint records how far it got.
+    """
+    for model, field_name in ORPHAN_MODELS:
+        checkpoint, created = CleanupCheckpoint.objects.get_or_create(name=orphan_checkpoint_name(model))
+        while checkpoint.last_id is not None:
+            if time.time() >= deadline:
+                return False
+
+            ids = list(model.objects.filter(id__gt=checkpoint.last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                # we've been through the whole table. We're done, until more logs are deleted.
+                checkpoint.last_id = None
+                checkpoint.save()
+                break
+
+            used = PageViewLog.objects.filter(**{field_name: OuterRef('pk')})
+            orphan_ids = list(model.objects.filter(id__in=ids).annotate(used=Exists(used)).filter(used=False).values_list('id', flat=True))
+            if orphan_ids:
+                qs = model.objects.filter(id__in=orphan_ids)
+                try:
+                    qs._raw_delete(qs.db)
+                except IntegrityError:
+                    pass
+
+            # record our progress
+            checkpoint.last_id = ids[-1]
+            checkpoint.save()
+
+            # give other writers a turn at the table.
+            time.sleep(sleep)
+
+    return True
+
+def cleanup_old_logs_daily(**kwargs):
+    """ The django-cron daily job. It gets a much bigger time budget than an hourly `purge_page_view_logs` would. """
+    if not cleanup_old_logs(max_seconds=PAGE_VIEW_LOG_CLEANUP_DAILY_MAX_SECONDS):
+        print("page_view_log: cleanup_old_logs ran out of time, and is falling behind. Consider running `manage.py purge_page_view_logs` more often.")
+
+if cron_daily is not None:
+    cron_daily.connect(cleanup_old_logs_daily, dispatch_uid="cleanup_old_logs")
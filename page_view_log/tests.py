@@ -1,4 +1,153 @@
 from __future__ import unicode_literals
-from django.test import TestCase
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory, override_settings
+from django.utils import timezone
+
+from page_view_log.middleware import PageViewLogMiddleware
+from page_view_log.models import UserAgent, Url, ViewName, PageViewLog, CleanupCheckpoint, cleanup_old_logs
+from page_view_log.utils import SpaceSaving, HeavyHitterTracker
+
+
+class SpaceSavingTest(TestCase):
+    def test_add_evicts_smallest_and_inherits_its_count(self):
+        sketch = SpaceSaving(2)
+        sketch.add('a', 3)
+        sketch.add('b')
+        sketch.add('c')
+        self.assertEqual(sketch.data, {'a': [3, 0], 'c': [2, 1]})
+
+    def test_merge_truncates_to_capacity(self):
+        sketch = SpaceSaving(2, {'a': [5, 0], 'b': [2, 0]})
+        sketch.merge({'a': [1, 0], 'c': [4, 0]})
+        # 'b' is missing from the other side (whose smallest count is 1), and 'c' is missing from ours (smallest count 2).
+        self.assertEqual(sketch.data, {'a': [6, 0], 'c': [6, 2]})
+
+    def test_merge_into_empty(self):
+        sketch = SpaceSaving(2)
+        sketch.merge({'a': [5, 1], 'b': [2, 0]})
+        self.assertEqual(sketch.data, {'a': [5, 1], 'b': [2, 0]})
+
+    def test_top_ordering_and_limit(self):
+        sketch = SpaceSaving(5, {'a': [1, 0], 'b': [3, 0], 'c': [2, 1]})
+        self.assertEqual(sketch.top(), [('b', 3, 0), ('c', 2, 1), ('a', 1, 0)])
+        self.assertEqual(sketch.top(2), [('b', 3, 0), ('c', 2, 1)])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class HeavyHitterTrackerTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_record_flush_top(self):
+        first = HeavyHitterTracker()
+        second = HeavyHitterTracker()
+        for i in range(3):
+            first.record('1.2.3.4', 7, '/a/')
+        first.record('5.6.7.8', None, '/b/')
+        second.record('1.2.3.4', None, '/b/')
+        first.flush()
+        second.flush()
+
+        # each writer gets its own slot, so neither overwrites the other.
+        self.assertNotEqual(first.slot, second.slot)
+
+        # (we look back 2 minutes, in case the minute rolled over mid-test)
+        self.assertEqual(HeavyHitterTracker.top('ip_address', minutes=2), [('1.2.3.4', 4, 0), ('5.6.7.8', 1, 0)])
+        self.assertEqual(HeavyHitterTracker.top('user_id', minutes=2), [(7, 3, 0)])
+        self.assertEqual(HeavyHitterTracker.top('url', minutes=2, limit=1), [('/a/', 3, 0)])
+
+        # flushing again overwrites our own slot, rather than double counting
+        first.flush()
+        self.assertEqual(HeavyHitterTracker.top('ip_address', minutes=2)[0], ('1.2.3.4', 4, 0))
+
+    @mock.patch('page_view_log.middleware.PAGE_VIEW_LOG_INCLUDES_ANONYMOUS', False)
+    @mock.patch('page_view_log.middleware.PAGE_VIEW_LOG_TRACK_HEAVY_HITTERS', True)
+    def test_middleware_counts_anonymous_requests(self):
+        tracker = HeavyHitterTracker()
+        request = RequestFactory().get('/hello/', REMOTE_ADDR='9.9.9.9')
+        request.session = SessionStore()
+        request.user = AnonymousUser()
+
+        with mock.patch('page_view_log.middleware.heavy_hitters', tracker):
+            PageViewLogMiddleware(lambda request: HttpResponse('hi'))(request)
+        tracker.flush()
+
+        self.assertEqual(HeavyHitterTracker.top('ip_address', minutes=2), [('9.9.9.9', 1, 0)])
+        self.assertEqual(HeavyHitterTracker.top('url', minutes=2), [('/hello/', 1, 0)])
+        self.assertEqual(HeavyHitterTracker.top('user_id', minutes=2), [])
+        # ...but we didn't log it.
+        self.assertFalse(PageViewLog.objects.exists())
+
+
+class CleanupOldLogsTest(TestCase):
+    def setUp(self):
+        self.user_agent = UserAgent.objects.create(user_agent_hash='ua', user_agent_string='ua')
+        self.url = Url.objects.create(url_hash='url', url_string='/')
+        self.view_name = ViewName.objects.create(view_name_hash='view', view_name_string='view')
+
+    def create_log(self, days_old, user_agent=None, url=None, view_name=None):
+        return PageViewLog.objects.create(
+            datetime = timezone.now() - timedelta(days=days_old),
+            ip_address = '127.0.0.1',
+            user_agent = user_agent or self.user_agent,
+            url = url or self.url,
+            view_name = view_name or self.view_name,
+            )
+
+    def last_id(self):
+        return CleanupCheckpoint.objects.get(name='cleanup_old_logs').last_id
+
+    def test_deletes_stale_logs_and_advances_checkpoint(self):
+        stale = [self.create_log(100) for i in range(3)]
+        self.assertTrue(cleanup_old_logs(chunk_size=2, sleep=0))
+        self.assertFalse(PageViewLog.objects.exists())
+        self.assertEqual(self.last_id(), stale[-1].id)
+
+    def test_resumes_after_checkpoint(self):
+        stale = [self.create_log(100) for i in range(4)]
+        CleanupCheckpoint.objects.create(name='cleanup_old_logs', last_id=stale[1].id)
+        self.assertTrue(cleanup_old_logs(sleep=0))
+        # anything at or before the checkpoint has already been handled, so it's not looked at again.
+        self.assertEqual(list(PageViewLog.objects.values_list('id', flat=True).order_by('id')), [stale[0].id, stale[1].id])
+        self.assertEqual(self.last_id(), stale[3].id)
+
+    def test_runs_out_of_time_after_one_chunk(self):
+        stale = [self.create_log(100) for i in range(5)]
+        self.assertFalse(cleanup_old_logs(max_seconds=0, chunk_size=2, sleep=0))
+        self.assertEqual(PageViewLog.objects.count(), 3)
+        self.assertEqual(self.last_id(), stale[1].id)
+
+        # the next run picks up where we left off.
+        self.assertFalse(cleanup_old_logs(max_seconds=0, chunk_size=2, sleep=0))
+        self.assertEqual(PageViewLog.objects.count(), 1)
+        self.assertEqual(self.last_id(), stale[3].id)
+
+    def test_current_logs_stop_the_walk(self):
+        stale = self.create_log(100)
+        current = self.create_log(1)
+        # out of order (ex: from a batched insert). We don't look past `current`.
+        later_stale = self.create_log(100)
+        self.assertTrue(cleanup_old_logs(sleep=0))
+        self.assertEqual(set(PageViewLog.objects.values_list('id', flat=True)), set([current.id, later_stale.id]))
+        self.assertEqual(self.last_id(), stale.id)
+
+    def test_removes_orphans(self):
+        old_user_agent = UserAgent.objects.create(user_agent_hash='old', user_agent_string='old')
+        old_url = Url.objects.create(url_hash='old', url_string='/old/')
+        old_view_name = ViewName.objects.create(view_name_hash='old', view_name_string='old')
+        self.create_log(100, user_agent=old_user_agent, url=old_url, view_name=old_view_name)
+        self.create_log(1)
+
+        self.assertTrue(cleanup_old_logs(chunk_size=1, sleep=0))
+        self.assertEqual(list(UserAgent.objects.all()), [self.user_agent])
+        self.assertEqual(list(Url.objects.all()), [self.url])
+        self.assertEqual(list(ViewName.objects.all()), [self.view_name])
+
+        # the orphan pass is finished, until more logs are deleted.
+        self.assertFalse(CleanupCheckpoint.objects.filter(name__startswith='cleanup_orphans:', last_id__isnull=False).exists())
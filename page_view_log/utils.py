@@ -5,10 +5,16 @@ from threading import local
 import time
 import random
 
+from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 
 from page_view_log.models import PageViewLog
 
+PAGE_VIEW_LOG_TRACK_HEAVY_HITTERS = bool(getattr(settings, 'PAGE_VIEW_LOG_TRACK_HEAVY_HITTERS', None))
+PAGE_VIEW_LOG_HEAVY_HITTERS_SIZE = getattr(settings, 'PAGE_VIEW_LOG_HEAVY_HITTERS_SIZE', 100)        # Number of keys to track, per dimension, per minute.
+PAGE_VIEW_LOG_HEAVY_HITTERS_WINDOW = getattr(settings, 'PAGE_VIEW_LOG_HEAVY_HITTERS_WINDOW', 60)     # Number of minutes to keep in the cache.
+
 class PageViewLogQueue(local):
     """ a thread local queue """
     def __init__(self, *args, **kwargs):
@@ -88,3 +94,133 @@ class MyLRUCache:
             del self.data[key]
 
 my_lru_cache = MyLRUCache()
+
+
+class SpaceSaving:
+    """ a bounded-memory 'top-K' counter (the space-saving algorithm).
+        Any key occurring more than 1/capacity of the time is guaranteed to be present. Counts are never too low, and are too high by at most `error`.
+        see: https://www.cs.ucsb.edu/sites/default/files/documents/2005-23.pdf
+        and, for merging: https://arxiv.org/abs/1202.5570 (Mergeable Summaries)
+    """
+    def __init__(self, capacity, data=None):
+        self.capacity = capacity
+        self.data = data or {
+            # key: [count, error],
+        }
+
+    def add(self, key, count=1):
+        if key in self.data:
+            self.data[key][0] += count
+        elif len(self.data) < self.capacity:
+            self.data[key] = [count, 0]
+        else:
+            # replace the smallest counter. The newcomer inherits its count, as an upper bound on what we may have missed.
+            min_key = min(self.data, key=lambda k: self.data[k][0])
+            min_count = self.data.pop(min_key)[0]
+            self.data[key] = [min_count + count, min_count]
+
+    def min_count(self, data):
+        """ the most that any key missing from `data` could have occurred. Zero, unless `data` is full. """
+        if len(data) < self.capacity:
+            return 0
+        return min(count for count, error in data.values())
+
+    def merge(self, data):
+        """ merges another summary (of the same capacity) into this one.
+            A key that's missing from one side may still have occurred there, up to that side's smallest count; so we add that to both its count and its error.
+        """
+        self_min = self.min_count(self.data)
+        other_min = self.min_count(data)
+        merged = {}
+        for key in set(self.data) | set(data):
+            count, error = self.data.get(key, (self_min, self_min))
+            other_count, other_error = data.get(key, (other_min, other_min))
+            merged[key] = [count + other_count, error + other_error]
+
+        # keep only the biggest counters. Anything dropped is no bigger than the smallest one we keep, so the guarantees still hold.
+        self.data = dict(heapq.nlargest(self.capacity, merged.items(), key=lambda item: item[1][0]))
+
+    def top(self, limit=None):
+        items = sorted(self.data.items(), key=lambda item: item[1][0], reverse=True)
+        return [(key, count, error) for key, (count, error) in items[:limit]]
+
+
+class HeavyHitterTracker(local):
+    """ a thread local tracker of the most active ip addresses, users and urls.
+        Counts are kept in memory, per minute, and periodically written to the shared cache; so that 'who is hammering us right now?' never requires a query against PageViewLog.
+        Each thread writes to its own cache key (a numbered 'slot'), so writers never overwrite each other's counts. They're merged when read.
+    """
+    dimensions = ('ip_address', 'user_id', 'url')
+
+    def __init__(self, *args, **kwargs):
+        self.bucket = None
+        self.reset()
+
+    def reset(self):
+        self.slot = None
+        self.sketches = dict((dimension, SpaceSaving(PAGE_VIEW_LOG_HEAVY_HITTERS_SIZE)) for dimension in self.dimensions)
+        self.last_flush = time.time()
+
+    def record(self, ip_address, user_id, url):
+        bucket = int(time.time() // 60)
+        if bucket != self.bucket:
+            # a new minute. Push the previous one out before we start counting again.
+            self.flush()
+            self.reset()
+            self.bucket = bucket
+        self.sketches['ip_address'].add(ip_address)
+        if user_id:
+            self.sketches['user_id'].add(user_id)
+        self.sketches['url'].add(url)
+
+        if self.last_flush < time.time() - 5:
+            self.flush()
+
+    def flush(self):
+        """ writes this minute's counts (so far) to the cache. Our in-memory counts cover the whole minute, so we simply overwrite our own slot. """
+        self.last_flush = time.time()
+        if self.bucket is None or not self.sketches['ip_address'].data:
+            return
+
+        timeout = (PAGE_VIEW_LOG_HEAVY_HITTERS_WINDOW + 1) * 60
+        try:
+            if self.slot is None:
+                # claim a slot for this minute. `incr` is atomic, so no two writers get the same one.
+                writers_key = self.writers_key(self.bucket)
+                cache.add(writers_key, 0, timeout)
+                self.slot = cache.incr(writers_key)
+
+            cache.set_many(dict(
+                (self.cache_key(dimension, self.bucket, self.slot), self.sketches[dimension].data)
+                for dimension in self.dimensions
+                ), timeout)
+        except Exception as e:
+            print("An error occurred saving the heavy hitters: '{}'".format(e))
+
+    @staticmethod
+    def writers_key(bucket):
+        return "pvl_heavy_hitters:writers:%s" % bucket
+
+    @staticmethod
+    def cache_key(dimension, bucket, slot):
+        return "pvl_heavy_hitters:%s:%s:%s" % (dimension, bucket, slot)
+
+    @classmethod
+    def top(cls, dimension, minutes=15, limit=20):
+        """ returns [(key, count, error), ...] for the busiest keys over the last few minutes, across all processes. """
+        minutes = max(1, min(minutes, PAGE_VIEW_LOG_HEAVY_HITTERS_WINDOW))
+        current = int(time.time() // 60)
+        buckets = range(current - minutes + 1, current + 1)
+        writers = cache.get_many([cls.writers_key(bucket) for bucket in buckets])
+
+        keys = []
+        for bucket in buckets:
+            num_writers = writers.get(cls.writers_key(bucket)) or 0
+            keys.extend(cls.cache_key(dimension, bucket, slot) for slot in range(1, num_writers + 1))
+
+        sketch = SpaceSaving(PAGE_VIEW_LOG_HEAVY_HITTERS_SIZE)
+        for data in cache.get_many(keys).values():
+            sketch.merge(data)
+        return sketch.top(limit)
+
+heavy_hitters = HeavyHitterTracker()
@@ -4,5 +4,6 @@ from setuptools import setup, find_packages
 setup(
   name='django-page_view_log',
   description='Simple page-view logging to help with forensics',
-  packages=['page_view_log'],
+  packages=find_packages(),
+  package_data={'page_view_log': ['templates/admin/page_view_log/*.html']},
 )